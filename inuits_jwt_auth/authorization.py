@@ -1,22 +1,39 @@
-import base64
 import functools
+import hashlib
 import json
 import requests
+import threading
+import time
 
 from abc import ABC
 from authlib.integrations.flask_oauth2 import (
     ResourceProtector,
     current_token as current_token_authlib,
 )
-from authlib.jose import jwt
+from authlib.jose import JsonWebKey, JsonWebToken
+from authlib.jose.errors import (
+    ExpiredTokenError,
+    InvalidClaimError,
+    InvalidTokenError as NotYetValidTokenError,
+    JoseError,
+    MissingClaimError,
+)
 from authlib.oauth2 import OAuth2Error
 from authlib.oauth2.rfc6749 import MissingAuthorizationError
-from authlib.oauth2.rfc6750 import BearerTokenValidator
+from authlib.oauth2.rfc6750 import BearerTokenValidator, InvalidTokenError
 from authlib.oauth2.rfc7523 import JWTBearerToken
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import datetime
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter, Retry
 from werkzeug.exceptions import Unauthorized, Forbidden
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 class MyResourceProtector(ResourceProtector):
     def __init__(self, logger, require_token=True):
@@ -57,22 +74,43 @@ class MyResourceProtector(ResourceProtector):
             self.raise_error_response(error)
 
     def __call__(self, permissions=None, optional=False):
-        def wrapper(f):
-            @functools.wraps(f)
-            def decorated(*args, **kwargs):
-                try:
-                    self.acquire_token(permissions)
-                except MissingAuthorizationError as error:
-                    if optional:
+        # bound and normalized once here, the wrappers below run on every request
+        acquire_token = self.acquire_token
+        permissions = frozenset(
+            [permissions] if isinstance(permissions, str) else permissions or ()
+        )
+        if optional:
+
+            def wrapper(f):
+                @functools.wraps(f)
+                def decorated_optional(*args, **kwargs):
+                    try:
+                        acquire_token(permissions)
+                    except MissingAuthorizationError:
                         return f(*args, **kwargs)
-                    raise Unauthorized(str(error))
-                except InsufficientPermissionError as error:
-                    raise Forbidden(str(error))
-                except OAuth2Error as error:
-                    raise Unauthorized(str(error))
-                return f(*args, **kwargs)
+                    except InsufficientPermissionError as error:
+                        raise Forbidden(str(error))
+                    except OAuth2Error as error:
+                        raise Unauthorized(str(error))
+                    return f(*args, **kwargs)
+
+                return decorated_optional
+
+        else:
+
+            def wrapper(f):
+                # MissingAuthorizationError is an OAuth2Error and ends up as Unauthorized
+                @functools.wraps(f)
+                def decorated(*args, **kwargs):
+                    try:
+                        acquire_token(permissions)
+                    except InsufficientPermissionError as error:
+                        raise Forbidden(str(error))
+                    except OAuth2Error as error:
+                        raise Unauthorized(str(error))
+                    return f(*args, **kwargs)
 
-            return decorated
+                return decorated
 
         return wrapper
 
@@ -84,6 +122,8 @@ class MyResourceProtector(ResourceProtector):
 
 
 class JWT(JWTBearerToken):
+    __permission_set = None
+
     def __get_roles(self):
         if any(x not in self for x in ["azp", "resource_access"]):
             return []
@@ -119,15 +159,71 @@ class JWT(JWTBearerToken):
             return True
         if not role_permission_mapping:
             return False
-        user_permissions = self.get_token_permissions(role_permission_mapping)
-        if any(x in user_permissions for x in permissions):
-            return True
-        return False
+        user_permissions = self.__get_permission_set(role_permission_mapping)
+        return not user_permissions.isdisjoint(permissions)
+
+    # a token gets reused within a request and by the token cache, compute this once
+    def __get_permission_set(self, role_permission_mapping):
+        if (
+            self.__permission_set
+            and self.__permission_set[0] is role_permission_mapping
+        ):
+            return self.__permission_set[1]
+        permission_set = frozenset().union(
+            *(
+                role_permission_mapping[role]
+                for role in self.__get_roles()
+                if role in role_permission_mapping
+            )
+        )
+        self.__permission_set = (role_permission_mapping, permission_set)
+        return permission_set
 
     def is_super_admin(self, super_admin_role="role_super_admin"):
         return super_admin_role in self.__get_roles()
 
 
+class TokenCache:
+    def __init__(self, max_size=4096, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token_string):
+        key = self.__get_key(token_string)
+        with self.lock:
+            if not (entry := self.entries.get(key)):
+                return None
+            value, expires_at = entry
+            if time.time() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, token_string, value, expires_at=None):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        # never keep an entry longer than the token itself is valid
+        expires_at = min(time.time() + self.ttl, expires_at or float("inf"))
+        key = self.__get_key(token_string)
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # raw tokens are not kept in memory, only a digest of them
+    @staticmethod
+    def __get_key(token_string):
+        return hashlib.blake2b(token_string.encode("utf-8"), digest_size=16).digest()
+
+
 class JWTValidator(BearerTokenValidator, ABC):
     TOKEN_TYPE = "bearer"
     token_cls = JWT
@@ -143,6 +239,13 @@ class JWTValidator(BearerTokenValidator, ABC):
         remote_token_validation=False,
         remote_public_key=None,
         realm_cache_sync_time=1800,
+        realm_retry_time=10,
+        token_cache_size=4096,
+        token_cache_ttl=5,
+        invalid_token_cache_size=8192,
+        invalid_token_cache_ttl=30,
+        request_timeout=(2, 5),
+        algorithms=None,
         **extra_attributes,
     ):
         super().__init__(**extra_attributes)
@@ -150,21 +253,63 @@ class JWTValidator(BearerTokenValidator, ABC):
         self.static_public_key = static_public_key
         self.logger = logger
         self.realms = realms if realms else []
+        # only accept the configured algorithms, never whatever the token header claims
+        if isinstance(algorithms, str):
+            algorithms = [algorithms]
+        self.algorithms = [
+            algorithm
+            for algorithm in (algorithms if algorithms else ["RS256"])
+            if algorithm.lower() != "none"
+        ]
+        if not self.algorithms:
+            raise ValueError(f"No usable signing algorithms in {algorithms}")
+        self.jwt = JsonWebToken(self.algorithms)
         self.claims_options = {
             "exp": {"essential": True},
             "azp": {"essential": True},
             "sub": {"essential": True},
         }
         self.role_permission_mapping = None
+        self.role_permission_sets = None
         self.super_admin_role = super_admin_role
         self.remote_token_validation = remote_token_validation
         self.remote_public_key = remote_public_key
+        self.static_realm_config = self.__import_public_key(
+            {"public_key": static_public_key}
+        )
+        self.remote_realm_config = self.__import_public_key(
+            {"public_key": remote_public_key}
+        )
         self.realm_cache_sync_time = realm_cache_sync_time
         self.realm_config_cache = {}
+        self.realm_config_locks = {}
+        self.realm_config_failures = {}
+        self.realm_retry_time = realm_retry_time
+        self.token_cache = TokenCache(token_cache_size, token_cache_ttl)
+        # replayed invalid tokens are rejected without verifying them again
+        self.invalid_token_cache = TokenCache(
+            invalid_token_cache_size, invalid_token_cache_ttl
+        )
+        self.request_timeout = request_timeout
+        # keep connections to the issuers alive between realm and userinfo requests
+        self.session = requests.Session()
+        # userinfo requests carry the end user's token, never replay cookies between them
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=2, backoff_factor=0.1),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         if role_permission_file_location:
             try:
                 with open(role_permission_file_location, "r") as file:
                     self.role_permission_mapping = json.load(file)
+                self.role_permission_sets = {
+                    role: frozenset(permissions)
+                    for role, permissions in self.role_permission_mapping.items()
+                }
             except IOError:
                 self.logger.error(
                     f"Could not read role_permission file: {role_permission_file_location}"
@@ -175,70 +320,166 @@ class JWTValidator(BearerTokenValidator, ABC):
                 )
 
     def authenticate_token(self, token_string):
-        issuer = self.__get_unverified_issuer(token_string)
-        if not issuer:
+        # with remote validation every request has to check the token is still logged in
+        if not self.remote_token_validation and (
+            claims := self.token_cache.get(token_string)
+        ):
+            return claims
+        if self.invalid_token_cache.get(token_string):
             return None
-        realm_config = self.__get_realm_config_by_issuer(issuer)
-        public_key = ""
-        if "public_key" in realm_config:
-            public_key = f'-----BEGIN PUBLIC KEY-----\n{realm_config["public_key"]}\n-----END PUBLIC KEY-----'
         try:
-            claims = jwt.decode(
+            claims = self.jwt.decode(
                 token_string,
-                public_key,
+                self.__get_public_key,
                 claims_options=self.claims_options,
                 claims_cls=self.token_cls,
             )
-            claims.validate()
             if self.remote_token_validation:
-                result = requests.get(
-                    f"{issuer}/protocol/openid-connect/userinfo",
+                result = self.session.get(
+                    f'{claims["iss"]}/protocol/openid-connect/userinfo',
                     headers={"Authorization": f"Bearer {token_string}"},
+                    timeout=self.request_timeout,
                 )
                 if result.status_code != 200:
                     raise Exception(result.content.strip())
+            else:
+                self.token_cache.set(token_string, claims, claims["exp"])
             return claims
+        except JoseError as error:
+            # a token that is not valid yet will be once its nbf passes
+            if not isinstance(error, NotYetValidTokenError):
+                self.invalid_token_cache.set(token_string, True)
+            self.logger.error(f"Authenticate token failed: {error}")
+            return None
         except Exception as error:
             self.logger.error(f"Authenticate token failed: {error}")
             return None
 
+    # jwt.decode passes the payload it already parsed, so the token is only decoded once
+    def __get_public_key(self, header, payload):
+        # runs before the signature is verified, reject on the cheap claim checks first
+        self.__validate_claims(header, payload)
+        if not (issuer := payload.get("iss")):
+            raise MissingClaimError("iss")
+        realm_config = self.__get_realm_config_by_issuer(issuer)
+        if "key" not in realm_config:
+            if issuer in self.realms:
+                # the issuer is fine, its config is unavailable: not a JoseError so
+                # the token isn't remembered as invalid
+                raise Exception(f"No public key available for realm {issuer}")
+            raise InvalidClaimError("iss")
+        return realm_config["key"]
+
+    # same checks as JWTClaims.validate, without building claims for the common case
+    # where the claims options only mark claims as essential
+    def __validate_claims(self, header, payload):
+        for claim, option in self.claims_options.items():
+            if option.keys() - {"essential"}:
+                self.token_cls(payload, header, options=self.claims_options).validate()
+                return
+            if not option.get("essential"):
+                continue
+            if claim not in payload:
+                raise MissingClaimError(claim)
+            if not payload[claim]:
+                raise InvalidClaimError(claim)
+        now = int(time.time())
+        for claim in ("exp", "nbf", "iat"):
+            if claim in payload and not isinstance(payload[claim], (int, float)):
+                raise InvalidClaimError(claim)
+        if "exp" in payload and payload["exp"] < now:
+            raise ExpiredTokenError()
+        if "nbf" in payload and payload["nbf"] > now:
+            raise NotYetValidTokenError()
+
     def __get_realm_config_by_issuer(self, issuer):
         if issuer == self.static_issuer:
-            return {"public_key": self.static_public_key}
+            return self.static_realm_config
         if issuer not in self.realms:
             return {}
         if self.remote_public_key:
-            return {"public_key": self.remote_public_key}
+            return self.remote_realm_config
+        if realm_config := self.__get_cached_realm_config(issuer):
+            return realm_config
+        # only one thread per issuer fetches an expired realm config, the others wait for it
+        with self.realm_config_locks.setdefault(issuer, threading.Lock()):
+            if realm_config := self.__get_cached_realm_config(issuer):
+                return realm_config
+            stale_realm_config = self.realm_config_cache.get(issuer)
+            current_time = datetime.timestamp(datetime.now())
+            failed_time = self.realm_config_failures.get(issuer)
+            if failed_time and current_time - failed_time < self.realm_retry_time:
+                if stale_realm_config:
+                    return stale_realm_config
+                raise Exception(f"Realm config for {issuer} is unavailable")
+            try:
+                response = self.session.get(issuer, timeout=self.request_timeout)
+                response.raise_for_status()
+                realm_config = json_loads(response.content)
+                # never replace a good config with one that can't verify tokens
+                if not isinstance(realm_config, dict):
+                    raise Exception(f"Invalid realm config for {issuer}")
+                if not realm_config.get("public_key"):
+                    raise Exception(f"Realm config for {issuer} has no public key")
+                realm_config = self.__import_public_key(realm_config)
+            except Exception as error:
+                # don't let every waiting request retry a failing issuer right away
+                self.realm_config_failures[issuer] = current_time
+                if not stale_realm_config:
+                    raise
+                self.logger.error(
+                    f"Refreshing realm config for {issuer} failed, using the cached one: {error}"
+                )
+                return stale_realm_config
+            self.realm_config_failures.pop(issuer, None)
+            realm_config["last_sync_time"] = current_time
+            self.realm_config_cache[issuer] = realm_config
+            return realm_config
+
+    def __get_cached_realm_config(self, issuer):
+        realm_config = self.realm_config_cache.get(issuer)
         current_time = datetime.timestamp(datetime.now())
         if (
-            issuer in self.realm_config_cache
-            and current_time - self.realm_config_cache[issuer]["last_sync_time"]
+            realm_config
+            and current_time - realm_config["last_sync_time"]
             < self.realm_cache_sync_time
         ):
-            return self.realm_config_cache[issuer]
-        self.realm_config_cache[issuer] = requests.get(issuer).json()
-        self.realm_config_cache[issuer]["last_sync_time"] = current_time
-        return self.realm_config_cache[issuer]
+            return realm_config
+        return None
+
+    # parse the public key once instead of letting jwt.decode parse the PEM for every token
+    @staticmethod
+    def __import_public_key(realm_config):
+        if "public_key" not in realm_config:
+            return realm_config
+        public_key = f'-----BEGIN PUBLIC KEY-----\n{realm_config["public_key"]}\n-----END PUBLIC KEY-----'
+        try:
+            realm_config["key"] = JsonWebKey.import_key(public_key)
+        except ValueError:
+            # not a valid PEM key, leave it to jwt.decode like before
+            realm_config["key"] = public_key
+        return realm_config
+
+    def invalidate_realm(self, issuer):
+        with self.realm_config_locks.setdefault(issuer, threading.Lock()):
+            self.realm_config_cache.pop(issuer, None)
+            self.realm_config_failures.pop(issuer, None)
+        # tokens verified with the old key must be checked against the new one, and
+        # tokens signed with the new key may have been rejected with the old one
+        self.token_cache.clear()
+        self.invalid_token_cache.clear()
 
     def validate_token(self, token, permissions, request):
-        super().validate_token(token, None, request)
+        # exp is already checked in authenticate_token and cached tokens never outlive it
+        if not token or token.is_revoked():
+            raise InvalidTokenError(
+                realm=self.realm, extra_attributes=self.extra_attributes
+            )
         if not token.has_permissions(
-            permissions, self.role_permission_mapping, self.super_admin_role
+            permissions, self.role_permission_sets, self.super_admin_role
         ):
             raise InsufficientPermissionError()
 
-    @staticmethod
-    def __get_unverified_issuer(token_string):
-        try:
-            # Adding "=="  is necessary for correct base64 padding
-            payload = f'{token_string.split(".")[1]}=='
-        except:
-            return None
-        decoded = json.loads(base64.urlsafe_b64decode(payload.encode("utf-8")))
-        if "iss" in decoded:
-            return decoded["iss"]
-        return None
-
 
 class InsufficientPermissionError(OAuth2Error):
     error = "insufficient_permission"